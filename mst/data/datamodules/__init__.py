@@ -1 +1 @@
-from .datamodule import DataModule
\ No newline at end of file
+from .datamodule import DataModule, CudaStreamPrefetcher, RepeatSampler
\ No newline at end of file
@@ -1,10 +1,60 @@
 
+import math 
 import pytorch_lightning as pl
 import torch
 from torch.utils.data.dataloader import DataLoader
 import torch.multiprocessing as mp 
-from torch.utils.data.sampler import WeightedRandomSampler, RandomSampler
+from torch.utils.data.sampler import Sampler, WeightedRandomSampler, RandomSampler
 
+class RepeatSampler(Sampler):
+    """Emits every index of 'sampler' 'repeats' times in a row, so that a worker loads a volume once and serves multiple random crops of it.
+    NOTE: The DataLoader assigns consecutive batches to different workers, so a volume is only reused within a batch 
+    (choose batch_size as a multiple of 'repeats'). All repeats of a batch belong to the same patient."""
+    def __init__(self, sampler, repeats):
+        self.sampler = sampler 
+        self.repeats = repeats 
+
+    def __len__(self):
+        return len(self.sampler)*self.repeats
+
+    def __iter__(self):
+        for idx in self.sampler:
+            for _ in range(self.repeats):
+                yield idx 
+
+
+class CudaStreamPrefetcher(object):
+    """Wraps a DataLoader (dict batches) and copies the next batch to the GPU on a separate CUDA stream while the current batch is processed"""
+    def __init__(self, loader, device):
+        self.loader = loader 
+        self.device = torch.device(device)
+        if self.device.type != 'cuda':
+            raise ValueError(f"CudaStreamPrefetcher requires a CUDA device, got '{self.device}'")
+        self.stream = torch.cuda.Stream(self.device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        next_batch = self._preload(iterator)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            for val in batch.values():
+                if torch.is_tensor(val):
+                    val.record_stream(current_stream) # Memory was allocated on self.stream but is used on current_stream 
+            next_batch = self._preload(iterator)
+            yield batch 
+
+    def _preload(self, iterator):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None 
+        with torch.cuda.stream(self.stream):
+            return {key: val.to(self.device, non_blocking=True) if torch.is_tensor(val) else val for key, val in batch.items()}
 
 
 class DataModule(pl.LightningDataModule):
@@ -20,6 +70,10 @@ class DataModule(pl.LightningDataModule):
                  num_workers: int = mp.cpu_count(),
                  seed: int = 0, 
                  pin_memory: bool = False,
+                 persistent_workers: bool = False,
+                 prefetch_factor: int = None,
+                 cuda_prefetch: bool = False,
+                 crops_per_volume: int = 1,
                  weights: list = None 
                 ):
         super().__init__()
@@ -38,8 +92,20 @@ class DataModule(pl.LightningDataModule):
         self.num_workers = num_workers
         self.seed = seed 
         self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.cuda_prefetch = cuda_prefetch
+        self.crops_per_volume = crops_per_volume
         self.weights = weights
 
+    def _loader_kwargs(self):
+        # Worker options are only valid (and only make sense) with worker processes 
+        return {
+            'num_workers': self.num_workers, 
+            'pin_memory': self.pin_memory, 
+            'persistent_workers': self.persistent_workers and self.num_workers > 0,
+            'prefetch_factor': self.prefetch_factor if self.num_workers > 0 else None
+        }
    
 
     def train_dataloader(self):
@@ -49,12 +115,23 @@ class DataModule(pl.LightningDataModule):
         if self.ds_train is not None:
             if self.weights is not None:
                 num_samples = len(self.weights) if self.num_train_samples is None else self.num_train_samples
+                num_samples = math.ceil(num_samples/self.crops_per_volume) # Keep number of samples per epoch, but draw fewer volumes 
                 sampler = WeightedRandomSampler(self.weights, num_samples=num_samples, generator=generator) 
             else:
                 num_samples = len(self.ds_train) if self.num_train_samples is None else self.num_train_samples
+                num_samples = math.ceil(num_samples/self.crops_per_volume)
                 sampler = RandomSampler(self.ds_train, num_samples=num_samples, replacement=False, generator=generator)
-            return DataLoader(self.ds_train, batch_size=self.batch_size, num_workers=self.num_workers, 
-                            sampler=sampler, generator=generator, drop_last=True, pin_memory=self.pin_memory)
+            if self.crops_per_volume > 1:
+                sampler = RepeatSampler(sampler, self.crops_per_volume)
+            loader = DataLoader(self.ds_train, batch_size=self.batch_size, sampler=sampler, generator=generator, 
+                              drop_last=True, **self._loader_kwargs())
+            # Only for a single process: Lightning does not inject its DistributedSampler if the DataLoader is wrapped  
+            single_process = (self.trainer is None) or (self.trainer.world_size == 1)
+            if self.cuda_prefetch and torch.cuda.is_available() and single_process:
+                device = self.trainer.strategy.root_device if self.trainer is not None else torch.device('cuda')
+                if device.type == 'cuda': # e.g. not for Trainer(accelerator='cpu') 
+                    loader = CudaStreamPrefetcher(loader, device)
+            return loader 
         
         raise AssertionError("A training set was not initialized.")
 
@@ -62,8 +139,8 @@ class DataModule(pl.LightningDataModule):
         generator = torch.Generator()
         generator.manual_seed(self.seed)
         if self.ds_val is not None:
-            return DataLoader(self.ds_val, batch_size=self.batch_size_val, num_workers=self.num_workers, shuffle=False, 
-                                generator=generator, drop_last=False, pin_memory=self.pin_memory)
+            return DataLoader(self.ds_val, batch_size=self.batch_size_val, shuffle=False, 
+                                generator=generator, drop_last=False, **self._loader_kwargs())
         
         raise AssertionError("A validation set was not initialized.")
 
@@ -72,8 +149,8 @@ class DataModule(pl.LightningDataModule):
         generator = torch.Generator()
         generator.manual_seed(self.seed)
         if self.ds_test is not None:
-            return DataLoader(self.ds_test, batch_size=self.batch_size_test, num_workers=self.num_workers, shuffle=False, 
-                            generator = generator, drop_last=False, pin_memory=self.pin_memory)
+            return DataLoader(self.ds_test, batch_size=self.batch_size_test, shuffle=False, 
+                            generator = generator, drop_last=False, **self._loader_kwargs())
        
         raise AssertionError("A test test set was not initialized.")
 
@@ -7,6 +7,7 @@ from torchio.typing import TypeRangeFloat, TypeTripletInt
 from torchio.transforms.transform import TypeMaskingMethod 
 from torchio import Subject, Image
 import torch 
+import torch.nn.functional as F
 
 
 
@@ -28,6 +29,78 @@ class ImageOrSubjectToTensor(object):
         else:
             return input.data.swapaxes(1,-1)
 
+def crop_or_pad_center(tensor: torch.Tensor, target_shape, pad_value=None):
+    """Center crop or pad a tensor [C, W, H, D] to target_shape without TorchIO Subject overhead. 
+    Same as CropOrPad(random_center=False, padding_mode='minimum') if pad_value is None, otherwise pads with pad_value.
+    Returns the tensor and the (negative if padded) start index of the output within the input."""
+    start, slices, pads = [], [slice(None)], [(0, 0)]
+    for size, target in zip(tensor.shape[1:], target_shape):
+        diff = size-target
+        ini = int(np.ceil(abs(diff)/2))
+        if diff > 0:
+            slices.append(slice(ini, ini+target))
+            pads.append((0, 0))
+            start.append(ini)
+        else:
+            slices.append(slice(None))
+            pads.append((ini, -diff-ini))
+            start.append(-ini)
+    if any(sum(pad) for pad in pads):
+        # Pad before crop with the minimum along each axis (numpy 'minimum' mode), same as tio.Pad in CropOrPad
+        kwargs = {'mode':'minimum'} if pad_value is None else {'mode':'constant', 'constant_values':pad_value}
+        tensor = torch.from_numpy(np.pad(tensor.numpy(), pads, **kwargs))
+    tensor = tensor[tuple(slices)]
+    return tensor, np.array(start)
+
+class ResampleFlip(tio.SpatialTransform):
+    """Resize (target_shape) or resample (target_spacing) and flip in a single grid_sample pass. 
+    Replaces tio.Resize, tio.Resample and tio.Flip, which each resample/traverse the full volume. 
+    Output grid (shape, spacing and origin) is the same as for tio.Resample, target_spacing takes precedence over target_shape.
+    NOTE: For target_shape, tio.Resize sometimes gets one voxel too many (ceil of a float error, e.g. 230->112) and crops it, 
+    which shifts its grid by one voxel. ResampleFlip always preserves the field of view, so the grids differ in that case."""
+    def __init__(self, target_shape=None, target_spacing=None, flip_axes=(), **kwargs):
+        super().__init__(**kwargs)
+        self.target_shape = target_shape
+        self.target_spacing = target_spacing
+        self.flip_axes = flip_axes
+        self.args_names = ['target_shape', 'target_spacing', 'flip_axes']
+
+    def apply_transform(self, subject: Subject) -> Subject:
+        for image in self.get_images(subject):
+            shape = np.array(image.spatial_shape)
+            if self.target_spacing is not None:
+                # Same as tio.Resample: exact target spacing, shape is rounded up (singleton axes are kept)
+                target_spacing = np.broadcast_to(self.target_spacing, 3)
+                scale = target_spacing/np.array(image.spacing) # New voxel size in old voxels 
+                target_shape = np.where(shape == 1, 1, np.ceil(shape*np.array(image.spacing)/target_spacing)).astype(int)
+            elif self.target_shape is not None:
+                # Field of view is preserved (as tio.Resize if it does not round up the shape, see docstring)
+                target_shape = np.broadcast_to(self.target_shape, 3).astype(int)
+                scale = shape/target_shape
+            else:
+                target_shape = shape 
+                scale = np.ones(3)
+
+            # Output voxel i is centered at input voxel (i+0.5)*scale-0.5, i.e. normalized coordinates u = s*v+(s-1) with s = target_shape*scale/shape 
+            # Grid coordinates (x, y, z) index the tensor axes in reversed order, i.e. TorchIO axis 'a' is grid coordinate '2-a'
+            s = target_shape*scale/shape
+            theta = torch.zeros((1, 3, 4))
+            for axis in range(3):
+                theta[0, 2-axis, 2-axis] = -s[axis] if axis in self.flip_axes else s[axis] # Flip output (after resampling)
+                theta[0, 2-axis, 3] = s[axis]-1
+            grid = F.affine_grid(theta, (1, image.data.shape[0], *target_shape.tolist()), align_corners=False)
+            mode = 'nearest' if image.type == tio.LABEL else 'bilinear'
+            data = F.grid_sample(image.data[None].float(), grid, mode=mode, padding_mode='border', align_corners=False)[0]
+
+            # Voxel size is scaled and origin is moved to the center of the first output voxel (tio.Flip does not change the affine)
+            affine = image.affine.copy()
+            affine[:3, 3] += affine[:3, :3] @ ((scale-1)/2)
+            affine[:3, :3] = affine[:3, :3]*scale 
+            image.set_data(data.to(image.data.dtype))
+            image.affine = affine 
+        return subject
+
+
 def parse_per_channel(per_channel, channels):
     if isinstance(per_channel, bool):
         if per_channel == True:
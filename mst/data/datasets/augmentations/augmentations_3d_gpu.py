@@ -0,0 +1,95 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+
+class ZNormalization(nn.Module):
+    """Batched ZNormalization (per channel, clip to percentiles first) for tensors of shape [B, C, D, H, W] on the GPU.
+    Equivalent to augmentations_3d.ZNormalization with masking_method=lambda x:(x>x.min()) & (x<x.max()),
+    but percentiles are estimated from a random subset of 'num_samples' voxels (fixed seed in eval mode for reproducible validation)."""
+    def __init__(self, percentiles=(0.5, 99.5), num_samples=200_000, eps=1e-8):
+        super().__init__()
+        self.percentiles = percentiles
+        self.num_samples = num_samples
+        self.eps = eps
+
+    def forward(self, x):
+        x_flat = x.flatten(2).float() # [B, C, N]
+        mask = (x_flat > x_flat.amin(-1, keepdim=True)) & (x_flat < x_flat.amax(-1, keepdim=True))
+
+        # Percentiles of masked voxels (non-masked voxels are ignored as NaN)
+        num_voxels = x_flat.shape[-1]
+        generator = None if self.training else torch.Generator(device=x.device).manual_seed(0)
+        idx = torch.randint(num_voxels, (self.num_samples,), device=x.device, generator=generator) if num_voxels > self.num_samples else slice(None)
+        samples = x_flat[..., idx].masked_fill(~mask[..., idx], float('nan'))
+        q = torch.tensor(self.percentiles, device=x.device)/100.0
+        lower, upper = torch.nanquantile(samples, q, dim=-1, keepdim=True)
+        x_flat = torch.clamp(x_flat, lower, upper)
+
+        # Standardize with mean and std of masked voxels
+        num_masked = mask.sum(-1, keepdim=True)
+        mean = (x_flat*mask).sum(-1, keepdim=True)/num_masked
+        std = ((((x_flat-mean)*mask)**2).sum(-1, keepdim=True)/(num_masked-1)).sqrt()
+        x_flat = (x_flat-mean)/std.clamp_min(self.eps)
+        return x_flat.reshape(x.shape).to(x.dtype)
+
+
+
+class RandomRotate(nn.Module):
+    """Rotate every sample of [B, C, D, H, W] by a random angle within 'degrees' in the H-W plane (around D-axis).
+    Equivalent to tio.RandomAffine(degrees=(0, 0, 0, 0, 0, degrees), default_pad_value='minimum') on TorchIO [C, W, H, D] images."""
+    def __init__(self, degrees=90):
+        super().__init__()
+        self.degrees = degrees 
+
+    def forward(self, x):
+        B, _, D, H, W = x.shape 
+        angle = torch.deg2rad(torch.rand(B, device=x.device)*self.degrees)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        theta = torch.zeros((B, 3, 4), device=x.device)
+        theta[:, 0, 0], theta[:, 0, 1] = cos, -sin*H/W  # Account for aspect ratio of normalized coordinates
+        theta[:, 1, 0], theta[:, 1, 1] = sin*W/H, cos
+        theta[:, 2, 2] = 1
+        grid = F.affine_grid(theta, x.shape, align_corners=False)
+
+        # Pad with minimum of each sample 
+        x_min = x.flatten(1).amin(1).view(B, 1, 1, 1, 1)
+        x = F.grid_sample((x-x_min).float(), grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        return (x+x_min).to(x_min.dtype)
+
+
+class RandomFlip(nn.Module):
+    """Flip every sample independently along each of the axes with probability p"""
+    def __init__(self, axes=(2, 3, 4), p=0.5):
+        super().__init__()
+        self.axes = axes
+        self.p = p 
+
+    def forward(self, x):
+        for axis in self.axes:
+            flip = torch.rand(x.shape[0], device=x.device) < self.p
+            x = torch.where(flip.view(-1, *[1]*(x.ndim-1)), x.flip(axis), x)
+        return x 
+
+
+class RandomInvert(nn.Module):
+    """Invert intensities (x -> -x) of every sample independently with probability p"""
+    def __init__(self, p=0.5):
+        super().__init__()
+        self.p = p 
+
+    def forward(self, x):
+        invert = torch.rand(x.shape[0], device=x.device) < self.p
+        return torch.where(invert.view(-1, *[1]*(x.ndim-1)), -x, x)
+
+
+class RandomNoise(nn.Module):
+    """Add Gaussian noise with a standard deviation drawn uniformly from 'std' for every sample"""
+    def __init__(self, std=(0.0, 0.25)):
+        super().__init__()
+        self.std = std 
+
+    def forward(self, x):
+        std = torch.empty(x.shape[0], device=x.device).uniform_(*self.std)
+        return x + torch.randn_like(x)*std.view(-1, *[1]*(x.ndim-1)).to(x.dtype)
@@ -1,10 +1,23 @@
 from pathlib import Path 
+import os 
+import json 
+import hashlib 
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np 
+import nibabel as nib 
 import pandas as pd 
 import torch.utils.data as data 
 import torchio as tio
 import torch
 
-from .augmentations.augmentations_3d import ImageOrSubjectToTensor, RescaleIntensity, ZNormalization, CropOrPad
+from .augmentations.augmentations_3d import ImageOrSubjectToTensor, RescaleIntensity, ZNormalization, CropOrPad, ResampleFlip, crop_or_pad_center
+
+
+def _nib_read(path_img):
+    """Read NIfTI with nibabel (much faster than SimpleITK for .nii.gz), returns tensor [C, W, H, D] and affine"""
+    nii = nib.load(str(path_img))
+    data = np.asarray(nii.dataobj, dtype=np.float32)
+    return torch.from_numpy(data).unsqueeze(0), nii.affine
 
 
 class DUKE_Dataset3D(data.Dataset):
@@ -26,64 +39,233 @@ class DUKE_Dataset3D(data.Dataset):
             random_center=False,
             noise=False, 
             to_tensor = True,
+            cache = False,
+            gpu_znorm = False, 
+            gpu_augment = False,
+            use_zarr = False,
+            quantize = False,
         ):
         self.path_root = self.PATH_ROOT if path_root is None else Path(path_root)
         self.path_root_data = self.path_root/'preprocessed_crop/data'
         self.split = split 
+        self.image_crop = image_crop
+        self.use_zarr = use_zarr # Read from 'sub.zarr' (see convert_to_zarr) instead of 'sub.nii.gz'
+        # Center crop can already be applied during reading if it directly follows loading (only chunks within the crop are read)
+        self._read_crop = image_crop if (transform is None) and (image_resize is None) and (resample is None) and not random_center else None 
+        # Flip and center crop are applied directly to the loaded tensor if they follow loading (avoids TorchIO Subject overhead)
+        self._raw_prep = (transform is None) and (image_resize is None) and (resample is None)
 
         if transform is None: 
-            self.transform = tio.Compose([
-                tio.Resize(image_resize) if image_resize is not None else tio.Lambda(lambda x: x),
-                tio.Resample(resample) if resample is not None else tio.Lambda(lambda x: x),
-                tio.Flip(1), # Just for viewing, otherwise upside down
-                CropOrPad(image_crop, random_center=random_center, padding_mode='minimum') if image_crop is not None else tio.Lambda(lambda x: x),
-                ZNormalization(per_channel=True, per_slice=False, masking_method=lambda x:(x>x.min()) & (x<x.max()), percentiles=(0.5, 99.5)),   # 0.5, 99.5   2.5, 97.5
-                # tio.Lambda(lambda x: x.moveaxis(1, 2) if torch.rand((1,),)[0]<0.5 else x ) if random_rotate else tio.Lambda(lambda x: x), # WARNING: 1,2 if Subject, 2, 3 if tensor
-                tio.RandomAffine(scales=0, degrees=(0, 0, 0, 0, 0,90), translation=0, isotropic=True, default_pad_value='minimum') if random_rotate else tio.Lambda(lambda x: x),
-                tio.RandomFlip((0,1,2)) if flip else tio.Lambda(lambda x: x), # WARNING: Padding mask 
-                tio.Lambda(lambda x:-x if torch.rand((1,),)[0]<0.5 else x, types_to_apply=[tio.INTENSITY]) if noise else tio.Lambda(lambda x: x),
-                tio.RandomNoise(std=(0.0, 0.25)) if noise else tio.Lambda(lambda x: x),
-
-                ImageOrSubjectToTensor() if to_tensor else tio.Lambda(lambda x: x)             
-            ])
+            # Deterministic preprocessing, computed once per UID if cache is enabled  
+            # NOTE: Steps are only added if enabled, as every step (also a no-op) copies the Subject 
+            pre_steps = []
+            if not self._raw_prep: # Otherwise done in load_img 
+                # Resize, Resample and Flip(1) (just for viewing, otherwise upside down) in one pass 
+                pre_steps.append(ResampleFlip(target_shape=image_resize, target_spacing=resample, flip_axes=(1,)))
+                if (image_crop is not None) and not random_center:
+                    pre_steps.append(CropOrPad(image_crop, random_center=False, padding_mode='minimum'))
+            znorm = ZNormalization(per_channel=True, per_slice=False, masking_method=lambda x:(x>x.min()) & (x<x.max()), percentiles=(0.5, 99.5)) # 0.5, 99.5   2.5, 97.5
+            random_crop = (image_crop is not None) and random_center 
+            if not (gpu_znorm or random_crop): # gpu_znorm: done by BasicClassifier 
+                pre_steps.append(znorm)
+            self.pre_transform = tio.Compose(pre_steps)
+            pre_config = {'image_resize': image_resize, 'resample': resample, 'image_crop': None if random_crop else image_crop, 
+                          'znorm': not (gpu_znorm or random_crop)}
+
+            # Stochastic augmentation, computed for every sample (gpu_augment: rotation, flip and noise done by BasicClassifier)
+            aug_steps = []
+            if random_crop:
+                aug_steps.append(CropOrPad(image_crop, random_center=True, padding_mode='minimum'))
+                if not gpu_znorm: # Normalize the crop (as for center crops), not the full volume 
+                    aug_steps.append(znorm)
+            # if random_rotate: aug_steps.append(tio.Lambda(lambda x: x.moveaxis(1, 2) if torch.rand((1,),)[0]<0.5 else x )) # WARNING: 1,2 if Subject, 2, 3 if tensor
+            if random_rotate and not gpu_augment:
+                aug_steps.append(tio.RandomAffine(scales=0, degrees=(0, 0, 0, 0, 0,90), translation=0, isotropic=True, default_pad_value='minimum'))
+            if flip and not gpu_augment:
+                aug_steps.append(tio.RandomFlip((0,1,2))) # WARNING: Padding mask 
+            if noise and not gpu_augment:
+                aug_steps.append(tio.Lambda(lambda x:-x if torch.rand((1,),)[0]<0.5 else x, types_to_apply=[tio.INTENSITY]))
+                aug_steps.append(tio.RandomNoise(std=(0.0, 0.25)))
+            if to_tensor:
+                aug_steps.append(ImageOrSubjectToTensor())
+            self.aug_transform = tio.Compose(aug_steps)
         else:
-            self.transform = transform
+            self.pre_transform = tio.Lambda(lambda x: x)
+            self.aug_transform = transform
+            pre_config = {'raw': True}
 
 
         # Get split file 
         path_csv = self.path_root/'preprocessed_crop/splits/split.csv'
-        path_or_stream = path_csv 
+        path_pq = path_csv.with_suffix('.parquet')
+        path_or_stream = path_pq 
+        if not path_pq.exists() or (path_pq.stat().st_mtime < path_csv.stat().st_mtime): 
+            # Conversion (again if split.csv was changed), parquet is read much faster and supports column/row selection 
+            path_tmp = path_pq.with_suffix(f'.{os.getpid()}.tmp')
+            try:
+                pd.read_csv(path_csv).to_parquet(path_tmp, engine='pyarrow')
+                path_tmp.rename(path_pq)
+            except OSError: # e.g. read-only dataset folder 
+                path_or_stream = path_csv 
         self.df = self.load_split(path_or_stream, fold=fold, split=split, fraction=fraction)
-        self.item_pointers = self.df.index.tolist()
+        self._uids = self.df['UID'].to_numpy() # Plain arrays avoid pandas row lookups in __getitem__ 
+        self._targets = self.df[self.LABEL].to_numpy()
+
+        # Cache of preprocessed volumes, one subdirectory per configuration of pre_transform (and quantization)
+        self.cache = cache 
+        cache_key = hashlib.md5(json.dumps({**pre_config, 'quantize': quantize}, sort_keys=True).encode()).hexdigest()[:8]
+        self.path_cache = self.path_root/'cache'/cache_key 
+
+        # Store and return volumes as int8 + per-volume scale, dequantized by BasicClassifier on the GPU 
+        # Only z-normalized volumes are quantized: raw intensities have outliers which would determine the scale 
+        self.quantize = quantize 
+        if quantize and not cache:
+            raise ValueError("Quantization is only supported for cached volumes, set cache=True")
+        if quantize and not pre_config.get('znorm', False):
+            raise ValueError("Quantization requires ZNormalization in pre_transform, set gpu_znorm=False and random_center=False")
+        if quantize and (transform is None) and (random_rotate or noise) and not gpu_augment:
+            raise ValueError("Rotation and noise require float volumes, set gpu_augment=True to use quantization")
+
+        # Last preprocessed volume of this worker, reused if the same UID is requested consecutively within a batch (see RepeatSampler)
+        self._last_uid = None 
+        self._last_vol = None 
+
+        # Threads to load the volumes of a batch concurrently (see __getitems__), created lazily in every worker 
+        self._executor = None 
+        self._executor_pid = None 
 
 
     def __len__(self):
-        return len(self.item_pointers)
+        return len(self._uids)
+
+    def load_volume(self, uid):
+        """Load volume and apply pre_transform (or read from cache). Returns image and scale (None if not quantized)"""
+        if uid != self._last_uid:
+            self._last_uid, self._last_vol = uid, self._read_volume(uid)
+        return self._last_vol
+
+    def _read_volume(self, uid):
+        if self.cache:
+            return self.load_cache(uid)
+        return self.pre_transform(self.load_img(self.path_root_data/f'Breast_MRI_{uid}'/'sub.nii.gz')), None 
+
+    def load_cache(self, uid):
+        path_cache = self.path_cache/f'{uid}.pt'
+        if not path_cache.exists():
+            img = self.pre_transform(self.load_img(self.path_root_data/f'Breast_MRI_{uid}'/'sub.nii.gz'))
+            if self.quantize:
+                scale = max(img.data.abs().max().item()/127, 1e-8)
+                item = {'data': (img.data/scale).round().clamp(-128, 127).to(torch.int8), 'scale': scale}
+            else:
+                item = {'data': img.data.to(torch.float16), 'scale': None}
+            item['affine'] = torch.from_numpy(img.affine)
+            path_cache.parent.mkdir(parents=True, exist_ok=True)
+            path_tmp = path_cache.with_suffix(f'.{os.getpid()}.tmp') # Write-then-rename as workers may race on the same UID  
+            torch.save(item, path_tmp)
+            path_tmp.rename(path_cache)
+        else:
+            item = torch.load(path_cache, mmap=True)
+        data = item['data'] if self.quantize else item['data'].float()
+        return tio.ScalarImage(tensor=data, affine=item['affine'].numpy()), item['scale']
 
     def load_img(self, path_img):
-        return tio.ScalarImage(path_img)
+        if self.use_zarr:
+            data, affine = self.read_zarr(path_img.parent/path_img.name.replace('.nii.gz', '.zarr'))
+        else:
+            data, affine = _nib_read(path_img)
+        if self._raw_prep:
+            data = data.flip(2) # Same as tio.Flip(1): Just for viewing, otherwise upside down
+            if self._read_crop is not None:
+                data, start = crop_or_pad_center(data, self._read_crop)
+                affine[:3, 3] += affine[:3, :3] @ start 
+        return tio.ScalarImage(tensor=data, affine=affine)
+
+    def read_zarr(self, path_img):
+        import zarr 
+        arr = zarr.open(str(path_img), mode='r')
+        affine = np.array(arr.attrs['affine'])
+        start = np.zeros(3, dtype=int)
+        slices = [slice(None)]
+        for axis, (size, target) in enumerate(zip(arr.shape[1:], self._read_crop or arr.shape[1:])):
+            diff = size-target
+            if diff > 0:
+                # Same bounds as CropOrPad after tio.Flip(1), i.e. mirrored bounds for axis=1
+                start[axis] = diff//2 if axis == 1 else int(np.ceil(diff/2))
+            slices.append(slice(start[axis], start[axis]+min(size, target)))
+        data = np.asarray(arr[tuple(slices)], dtype=np.float32)
+        affine[:3, 3] += affine[:3, :3] @ start 
+        return torch.from_numpy(data), affine
+
+    def convert_to_zarr(self, overwrite=False):
+        """One-time conversion of all 'sub.nii.gz' of this dataset into chunked 'sub.zarr' stores"""
+        import zarr 
+        chunks = (1, *(self.image_crop or (224, 224, 32)))
+        for uid in self._uids:
+            path_dir = self.path_root_data/f'Breast_MRI_{uid}'
+            if (path_dir/'sub.zarr').exists() and not overwrite:
+                continue 
+            nii = nib.load(str(path_dir/'sub.nii.gz'))
+            data = np.asarray(nii.dataobj)[None]
+            arr = zarr.open(str(path_dir/'sub.zarr'), mode='w', shape=data.shape, chunks=chunks, dtype=data.dtype)
+            arr[:] = data 
+            arr.attrs['affine'] = nii.affine.tolist()
 
     def load_map(self, path_img):
         return tio.LabelMap(path_img)
 
     def __getitem__(self, index):
-        idx = self.item_pointers[index]
-        item = self.df.loc[idx]
-        target = item[self.LABEL]
-        uid = item['UID']
+        uid = self._uids[index]
+        return self._get_item(uid, self._targets[index], self.load_volume(uid))
+
+    def __getitems__(self, indices):
+        """Used by the DataLoader to fetch a batch: volumes are loaded in background threads (decompression releases 
+        the GIL) while the already loaded volumes are augmented"""
+        if self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=2)
+            self._executor_pid = os.getpid()
 
-        img = self.load_img(self.path_root_data/f'Breast_MRI_{uid}'/'sub.nii.gz')
-        img = self.transform(img)
+        uids = [self._uids[index] for index in indices]
+        vols = {self._last_uid: self._last_vol} if self._last_uid is not None else {}
+        futures = {uid: self._executor.submit(self._read_volume, uid) for uid in dict.fromkeys(uids) if uid not in vols}
 
-        return {'uid':uid, 'source': img, 'target':target}
+        items = []
+        for index, uid in zip(indices, uids):
+            if uid not in vols:
+                vols[uid] = futures[uid].result()
+            items.append(self._get_item(uid, self._targets[index], vols[uid]))
+        self._last_uid, self._last_vol = uids[-1], vols[uids[-1]]
+        return items 
+
+    def __getstate__(self):
+        # Thread pool can't be pickled (e.g. when workers are spawned)
+        state = self.__dict__.copy()
+        state['_executor'], state['_executor_pid'] = None, None 
+        return state 
+
+    def _get_item(self, uid, target, vol):
+        img, scale = vol
+        img = self.aug_transform(img)
+        if self.quantize:
+            return {'uid':uid, 'source': img, 'scale':scale, 'target':int(target)}
+        return {'uid':uid, 'source': img, 'target':int(target)}
 
 
+    @classmethod
+    def dataloader_kwargs(cls):
+        """Recommended DataLoader/DataModule settings: volumes are large, decoding is CPU-bound"""
+        return {'pin_memory':True, 'persistent_workers':True, 'prefetch_factor':4, 'num_workers':os.cpu_count()//2}
+
     @classmethod
     def load_split(cls, filepath_or_buffer=None, fold=0, split=None, fraction=None):
-        df = pd.read_csv(filepath_or_buffer)
-        df = df[df['Fold'] == fold]
-        if split is not None:
-            df = df[df['Split'] == split]   
+        if str(filepath_or_buffer).endswith('.parquet'):
+            # Only required columns are read and fold/split selection is pushed down to pyarrow 
+            filters = [('Fold', '==', fold)] + ([('Split', '==', split)] if split is not None else [])
+            df = pd.read_parquet(filepath_or_buffer, engine='pyarrow', columns=['Fold', 'Split', 'UID', cls.LABEL], filters=filters)
+        else:
+            df = pd.read_csv(filepath_or_buffer)
+            df = df[df['Fold'] == fold]
+            if split is not None:
+                df = df[df['Split'] == split]   
         if fraction is not None:
             df = df.sample(frac=fraction, random_state=0).reset_index()
         return df
\ No newline at end of file
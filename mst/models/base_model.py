@@ -5,6 +5,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import pytorch_lightning as pl
 from torchmetrics import MeanSquaredError, Accuracy, AUROC
+from mst.models.utils.metrics import BufferedMulticlassAUROC
+from mst.data.datasets.augmentations.augmentations_3d_gpu import ZNormalization, RandomRotate, RandomFlip, RandomInvert, RandomNoise
 
 
 class VeryBasicModel(pl.LightningModule):
@@ -70,14 +72,21 @@ class VeryBasicModel(pl.LightningModule):
 
         checkpoint = torch.load(checkpoint_path, map_location=map_location)
      
+        kwargs.setdefault('assign', True) # Tensors were just loaded and are not used elsewhere, no need to copy them 
         return self.load_weights(checkpoint["state_dict"], **kwargs)
     
-    def load_weights(self, pretrained_weights, strict=True, **kwargs):
+    def load_weights(self, pretrained_weights, strict=True, assign=False, **kwargs):
+        """Load the intersection of 'pretrained_weights' and the model state. 
+        assign=True: Take over the tensors instead of copying them, i.e. the model shares their storage."""
         filter = kwargs.get('filter', lambda key:key in pretrained_weights)
-        init_weights = self.state_dict()
+        model_state = self.state_dict()
         pretrained_weights = {key: value for key, value in pretrained_weights.items() if filter(key)}
-        init_weights.update(pretrained_weights)
-        self.load_state_dict(init_weights, strict=strict)
+        unexpected_keys = pretrained_weights.keys() - model_state.keys()
+        if strict and unexpected_keys:
+            raise RuntimeError(f"Unexpected key(s) in state_dict: {', '.join(sorted(unexpected_keys))}")
+        # Tensors are moved to the device/dtype of the model first (no-op if they match), e.g. for checkpoints saved on GPU 
+        self.load_state_dict({key: pretrained_weights[key].to(device=model_state[key].device, dtype=model_state[key].dtype) 
+                              for key in pretrained_weights.keys() & model_state.keys()}, strict=False, assign=assign)
         return self 
 
 
@@ -109,6 +118,13 @@ class BasicModel(VeryBasicModel):
         else:
             return [optimizer]
 
+    def on_before_batch_transfer(self, batch, dataloader_idx):
+        # Ensure page-locked memory for all tensors so that the host-to-device copy can be asynchronous 
+        if isinstance(batch, dict) and torch.cuda.is_available():
+            batch = {key: val.pin_memory() if torch.is_tensor(val) and val.device.type == 'cpu' and not val.is_pinned() else val 
+                     for key, val in batch.items()}
+        return batch 
+
 
 
 
@@ -129,19 +145,35 @@ class BasicClassifier(BasicModel):
         # acc_kwargs={"task":"binary"}
         aucroc_kwargs={"task":"multiclass"},
         acc_kwargs={"task":"multiclass"},
+        gpu_znorm=False, # Normalize 'source' within the training/validation/test step (dataset must skip ZNormalization)
+        gpu_augment=False, # Augment 'source' within the training step (dataset must skip rotation, flip and noise)
+        channels_last=False, # Use channels_last_3d memory format for 'source' and Conv3d weights (only spatial_dims=3)
         save_hyperparameters=True,
     ):
         super().__init__(optimizer, optimizer_kwargs, lr_scheduler, lr_scheduler_kwargs, save_hyperparameters)
         self.in_ch = in_ch 
         self.out_ch = out_ch 
         self.spatial_dims = spatial_dims
-        self.loss_func = loss(**loss_kwargs)
+        # Cross entropy (without class weights) is computed functionally on FP32 logits, see compute_loss 
+        self.loss_func = None if (loss is torch.nn.CrossEntropyLoss) and ('weight' not in loss_kwargs) else loss(**loss_kwargs)
         self.loss_kwargs = loss_kwargs 
+        self.source_norm = ZNormalization(percentiles=(0.5, 99.5)) if gpu_znorm else nn.Identity()
+        self.source_aug = nn.Sequential(
+            RandomRotate(degrees=90),
+            RandomFlip(axes=(2, 3, 4)),
+            RandomInvert(),
+            RandomNoise(std=(0.0, 0.25)),
+        ) if gpu_augment else nn.Identity()
+        self.channels_last = channels_last and (spatial_dims == 3)
 
         aucroc_kwargs.update({'num_classes':out_ch}) 
         acc_kwargs.update({'num_classes':out_ch}) 
 
-        self.auc_roc = nn.ModuleDict({state:AUROC(**aucroc_kwargs) for state in ["train_", "val_", "test_"]}) # 'train' not allowed as key
+        if aucroc_kwargs.get('task') == 'multiclass': # Preallocated buffer instead of a growing list of tensors 
+            aucroc = lambda: BufferedMulticlassAUROC(**{key:val for key, val in aucroc_kwargs.items() if key != 'task'})
+        else:
+            aucroc = lambda: AUROC(**aucroc_kwargs)
+        self.auc_roc = nn.ModuleDict({state:aucroc() for state in ["train_", "val_", "test_"]}) # 'train' not allowed as key
         self.acc = nn.ModuleDict({state:Accuracy(**acc_kwargs) for state in ["train_", "val_", "test_"]})
 
     
@@ -151,6 +183,17 @@ class BasicClassifier(BasicModel):
         batch_size = target.shape[0]
         self.batch_size = batch_size 
 
+        # Dequantize int8 volumes (see DUKE_Dataset3D(quantize=True))
+        if 'scale' in batch:
+            batch['source'] = batch['source'].float()*batch['scale'].float().view(-1, *[1]*(batch['source'].ndim-1))
+
+        # Normalize and augment (on GPU)
+        batch['source'] = self.source_norm(batch['source'])
+        if self.training:
+            batch['source'] = self.source_aug(batch['source'])
+        if self.channels_last:
+            batch['source'] = batch['source'].contiguous(memory_format=torch.channels_last_3d)
+
         # Run Model 
         pred = self(**batch)
 
@@ -160,17 +203,25 @@ class BasicClassifier(BasicModel):
 
         # --------------------- Compute Metrics  -------------------------------
         with torch.no_grad():
-            # Aggregate here to compute for entire set later 
-            self.acc[state+"_"].update(pred, target)
-            self.auc_roc[state+"_"].update(pred, target) 
+            # Aggregate here to compute for entire set later (detached, so metrics don't keep the graph alive)
+            pred_d = pred.detach()
+            self.acc[state+"_"].update(pred_d, target)
+            self.auc_roc[state+"_"].update(pred_d, target) 
             
             # ----------------- Log Scalars ----------------------
-            for metric_name, metric_val in logging_dict.items():
-                self.log(f"{state}/{metric_name}", metric_val, batch_size=batch_size, on_step=True, on_epoch=True, 
-                         sync_dist=False) 
+            self.log_dict({f"{state}/{metric_name}": metric_val for metric_name, metric_val in logging_dict.items()}, 
+                          batch_size=batch_size, on_step=True, on_epoch=True, sync_dist=False) 
 
         return logging_dict['loss'] 
 
+    def configure_model(self):
+        # Called by the Trainer before the model is wrapped (e.g. DDP), must be idempotent 
+        if self.channels_last:
+            # Only 5D weights (Conv3d) support channels_last_3d, parameters keep their identity
+            for param in self.parameters():
+                if param.ndim == 5:
+                    param.data = param.data.contiguous(memory_format=torch.channels_last_3d)
+
     def _epoch_end(self, state):
         for name, value in [("ACC", self.acc[state+"_"]), ("AUC_ROC", self.auc_roc[state+"_"])]:
             self.log(f"{state}/{name}", value.compute(), batch_size=self.batch_size, on_step=False, on_epoch=True, 
@@ -178,4 +229,7 @@ class BasicClassifier(BasicModel):
             value.reset()
 
     def compute_loss(self, pred, target):
-        return self.loss_func(pred, target)
\ No newline at end of file
+        # Cast logits to FP32 so that the loss is stable under AMP (FP16/BF16) 
+        if self.loss_func is None:
+            return F.cross_entropy(pred.float(), target, **self.loss_kwargs)
+        return self.loss_func(pred.float(), target)
\ No newline at end of file
@@ -0,0 +1,42 @@
+import torch 
+from torchmetrics.classification import MulticlassAUROC
+
+
+class BufferedMulticlassAUROC(MulticlassAUROC):
+    """MulticlassAUROC that writes predictions and targets of every step into a preallocated buffer on the metric device
+    (doubled if full, reused after reset) instead of appending a new tensor to a list, which is concatenated in compute()."""
+    def __init__(self, *args, max_samples=1024, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_samples = max_samples 
+        self._buffer_preds = None 
+        self._buffer_target = None 
+        self._cursor = 0 
+
+    def update(self, preds: torch.Tensor, target: torch.Tensor) -> None:
+        super().update(preds, target) # Validation and formatting (eg. softmax) 
+        if self.thresholds is not None: # Binned mode already has a constant size state 
+            return 
+        preds, target = self.preds.pop(), self.target.pop()
+        self._append(preds, target)
+        # States are views into the buffer, so syncing and compute() work unchanged 
+        self.preds = [self._buffer_preds[:self._cursor]]
+        self.target = [self._buffer_target[:self._cursor]]
+
+    def _append(self, preds, target):
+        num = preds.shape[0]
+        capacity = 0 if self._buffer_preds is None else self._buffer_preds.shape[0]
+        if (self._cursor+num > capacity) or (self._buffer_preds.device != preds.device):
+            capacity = max(self.max_samples, 2*capacity, self._cursor+num)
+            buffer_preds = torch.empty((capacity, *preds.shape[1:]), dtype=preds.dtype, device=preds.device)
+            buffer_target = torch.empty((capacity, *target.shape[1:]), dtype=target.dtype, device=target.device)
+            if self._cursor > 0:
+                buffer_preds[:self._cursor] = self._buffer_preds[:self._cursor]
+                buffer_target[:self._cursor] = self._buffer_target[:self._cursor]
+            self._buffer_preds, self._buffer_target = buffer_preds, buffer_target
+        self._buffer_preds[self._cursor:self._cursor+num] = preds 
+        self._buffer_target[self._cursor:self._cursor+num] = target 
+        self._cursor += num 
+
+    def reset(self) -> None:
+        super().reset()
+        self._cursor = 0 
@@ -52,8 +52,10 @@ if __name__ == "__main__":
     torch.set_float32_matmul_precision('high')
 
     # ------------ Load Data ----------------
-    ds_train = get_dataset(args.dataset, split='train', flip=True, noise=True, random_center=True, random_rotate=True)
-    ds_val = get_dataset(args.dataset, split='val')
+    gpu_transform = args.dataset == 'DUKE' # Normalize and augment within the training step on the GPU 
+    ds_kwargs = {'gpu_znorm': True, 'gpu_augment': True} if gpu_transform else {}
+    ds_train = get_dataset(args.dataset, split='train', flip=True, noise=True, random_center=True, random_rotate=True, **ds_kwargs)
+    ds_val = get_dataset(args.dataset, split='val', **ds_kwargs)
     
     samples = len(ds_train) + len(ds_val)
     batch_size = 2 
@@ -69,14 +71,17 @@ if __name__ == "__main__":
         ds_val=ds_val,
         ds_test=ds_val,
         batch_size=batch_size, 
-        pin_memory=True,
         weights=weights,
-        num_workers=24,
+        cuda_prefetch=True,
+        **(ds_train.dataloader_kwargs() if args.dataset == 'DUKE' else {'pin_memory':True, 'num_workers':24}),
         num_train_samples=min(len(ds_train), 2000)
     )
 
     # ------------ Initialize Model ------------
     model = get_model(args.model, 
+                      gpu_znorm=gpu_transform,
+                      gpu_augment=gpu_transform,
+                      channels_last=True, # Only used by 3D models 
                     #   use_registers = True,
                     #   model_size='s',
                     #   use_bottleneck=True,
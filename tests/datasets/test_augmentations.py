@@ -0,0 +1,47 @@
+import numpy as np
+import torch
+import torchio as tio
+from mst.data.datasets.augmentations.augmentations_3d import CropOrPad, ResampleFlip, ZNormalization, crop_or_pad_center
+from mst.data.datasets.augmentations.augmentations_3d_gpu import ZNormalization as ZNormalizationGPU
+
+torch.manual_seed(0)
+affine = np.diag([0.5, 0.5, 1.5, 1.0])
+img = tio.ScalarImage(tensor=torch.rand((1, 230, 210, 35)), affine=affine) # [C, W, H, D], crop and pad
+
+
+# ------------ crop_or_pad_center vs. CropOrPad ----------------
+target_shape = (224, 224, 32)
+ref = CropOrPad(target_shape, random_center=False, padding_mode='minimum')(img)
+out, start = crop_or_pad_center(img.data, target_shape)
+print("crop_or_pad_center", list(out.shape), "max. diff", (out-ref.data).abs().max().item())
+assert torch.equal(out, ref.data)
+assert np.allclose(affine[:3, 3]+affine[:3, :3] @ start, ref.affine[:3, 3])
+
+
+# ------------ ResampleFlip vs. Resize/Resample + Flip ----------------
+# NOTE: Shapes/spacings are chosen such that all output voxels lie within the input (TorchIO pads with 0 outside, ResampleFlip with border values)
+# and such that tio.Resize does not round up the shape (otherwise its grid is shifted by one voxel, see ResampleFlip)
+for kwargs, ref_transform in [
+        ({'target_shape':(92, 84, 28)}, tio.Compose([tio.Resize((92, 84, 28)), tio.Flip(1)])),
+        ({'target_spacing':(1.0, 1.0, 1.5)}, tio.Compose([tio.Resample((1.0, 1.0, 1.5)), tio.Flip(1)])),
+    ]:
+    ref = ref_transform(img)
+    out = ResampleFlip(flip_axes=(1,), **kwargs)(img)
+    print("ResampleFlip", kwargs, list(out.shape), "max. diff", (out.data-ref.data).abs().max().item())
+    assert out.shape == ref.shape
+    assert np.allclose(out.affine, ref.affine, atol=1e-5)
+    assert torch.allclose(out.data, ref.data, atol=1e-4)
+
+
+# ------------ GPU ZNormalization vs. ZNormalization ----------------
+znorm = ZNormalization(per_channel=True, per_slice=False, masking_method=lambda x:(x>x.min()) & (x<x.max()), percentiles=(0.5, 99.5))
+ref = znorm(tio.ScalarImage(tensor=img.data.clone(), affine=affine))
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+out = ZNormalizationGPU(percentiles=(0.5, 99.5), num_samples=img.data.numel()).eval().to(device)(img.data[None].to(device))[0].cpu()
+print("ZNormalization", "max. diff", (out-ref.data).abs().max().item())
+assert torch.allclose(out, ref.data, atol=1e-4)
+
+# Estimate from a random subset of voxels
+out = ZNormalizationGPU(percentiles=(0.5, 99.5)).eval().to(device)(img.data[None].to(device))[0].cpu()
+print("ZNormalization (sampled)", "max. diff", (out-ref.data).abs().max().item())
+assert torch.allclose(out, ref.data, atol=1e-2)
@@ -0,0 +1,21 @@
+import torch
+from torchmetrics.classification import MulticlassAUROC
+from mst.models.utils.metrics import BufferedMulticlassAUROC
+
+torch.manual_seed(0)
+num_classes = 3
+metric = BufferedMulticlassAUROC(num_classes=num_classes, max_samples=4) # Small buffer, grows several times
+ref = MulticlassAUROC(num_classes=num_classes)
+
+for epoch in range(2): # Second epoch reuses the buffer after reset()
+    for batch_size in [3, 2, 5, 1, 8, 4]:
+        pred = torch.randn((batch_size, num_classes))
+        target = torch.randint(num_classes, (batch_size,))
+        metric.update(pred, target)
+        ref.update(pred, target)
+
+    auc, auc_ref = metric.compute(), ref.compute()
+    print("Epoch", epoch, "AUROC", auc.item(), "Reference", auc_ref.item(), "Buffer", metric._buffer_preds.shape[0])
+    assert torch.allclose(auc, auc_ref)
+    metric.reset()
+    ref.reset()